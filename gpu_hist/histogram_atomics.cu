@@ -6,6 +6,13 @@
 #define iType %(c_itype)s
 #define histoType %(c_histotype)s
 #define changeType %(c_changetype)s
+// Specialization of the kernels. The dimensions are known when the module
+// is compiled which allows the compiler to unroll the loops over them.
+// The kernels still take no_of_dimensions as argument to keep their
+// signatures.
+#define NO_OF_DIMS %(no_of_dims)s
+// Block size of the max- and min-reduction. Must be a power of two.
+#define REDUCE_BLOCK_DIM %(reduce_block_dim)s
 
 // See ieee floating point specification
 #define CUDART_INF_F __ull_as_fType(0x7ff0000000000000ULL)
@@ -93,62 +100,167 @@ __device__ fType atomicAddfType(fType *address, fType val)
     return __change_as_fType(old);
 }
 
+// The per-block histograms are only updated by threads of the same block.
+// Devices with compute capability 6.0 and higher support atomics with block
+// scope which are cheaper than the device wide atomics.
+__device__ __forceinline__ void atomicAddBlock(histoType *address,
+    histoType val)
+{
+#if __CUDA_ARCH__ >= 600
+    atomicAdd_block(address, val);
+#else
+    atomicAdd(address, val);
+#endif
+}
+
+// Increment a bin of a per-block histogram. Threads of a warp which hit the
+// same bin are combined and only one of them adds the number of those
+// threads. This helps a lot if most events fall into a few bins.
+// __match_any_sync needs compute capability 7.0 or higher.
+__device__ __forceinline__ void atomicIncBlockAggregated(histoType *hist,
+    int bin)
+{
+#if __CUDA_ARCH__ >= 700
+    unsigned int peers = __match_any_sync(__activemask(), bin);
+    int leader = __ffs(peers) - 1;
+    if((threadIdx.x & 31) == leader)
+    {
+        atomicAddBlock(&hist[bin], __popc(peers));
+    }
+#else
+    atomicAddBlock(&hist[bin], 1);
+#endif
+}
+
+// Same as atomicAddfType() but with block scope.
+__device__ fType atomicAddfTypeBlock(fType *address, fType val)
+{
+    changeType* address_as_ull = (changeType*) address;
+    changeType old = *address_as_ull, assumed;
+    do
+    {
+        assumed = old;
+#if __CUDA_ARCH__ >= 600
+        old = atomicCAS_block(address_as_ull, assumed,
+                              __fType_as_change(val + __change_as_fType(assumed)));
+#else
+        old = atomicCAS(address_as_ull, assumed,
+                        __fType_as_change(val + __change_as_fType(assumed)));
+#endif
+    } while(assumed != old);
+    return __change_as_fType(old);
+}
+
+// The range and scale of each dimension are the same for all events.
+// Multiplying with the number of bins per unit avoids a division for
+// each value. The bin width is used to check the bins at the edges, see
+// get_bin(). Inlined such that the arrays stay in registers.
+__device__ __forceinline__ void load_bin_ranges(const fType *min_in,
+        const fType *max_in, const iType *no_of_bins, fType *range_min,
+        fType *range_max, fType *bin_scale, fType *bin_width)
+{
+    #pragma unroll
+    for(unsigned int d = 0; d < NO_OF_DIMS; d++)
+    {
+        range_min[d] = min_in[d];
+        range_max[d] = max_in[d];
+        bin_scale[d] = no_of_bins[d]/(range_max[d]-range_min[d]);
+        // Rounded division even with --use_fast_math
+#ifdef DOUBLE_PRECISION
+        bin_width[d] = __ddiv_rn(range_max[d]-range_min[d], no_of_bins[d]);
+#else
+        bin_width[d] = __fdiv_rn(range_max[d]-range_min[d], no_of_bins[d]);
+#endif
+    }
+}
+
+// Edge i of equally spaced bins, computed like numpy.linspace does
+// (i*width + min). The intrinsics round each step such that this is not
+// contracted to a fused multiply-add.
+__device__ __forceinline__ fType linspace_edge(const int i,
+        const fType range_min, const fType bin_width)
+{
+#ifdef DOUBLE_PRECISION
+    return __dadd_rn(__dmul_rn((fType) i, bin_width), range_min);
+#else
+    return __fadd_rn(__fmul_rn((fType) i, bin_width), range_min);
+#endif
+}
+
+// Bin of a value within [range_min, range_min + n_bins*bin_width]. The
+// scaled value can be off by one bin next to an edge, hence the bin is
+// checked against its edges. Values on an inner edge belong to the upper
+// bin and the maximum to the last bin, as in numpy.histogramdd.
+__device__ __forceinline__ int get_bin(const fType val, const fType range_min,
+        const fType bin_scale, const fType bin_width, const iType n_bins)
+{
+    int bin = (val-range_min)*bin_scale;
+    if(bin >= (int) n_bins) bin = n_bins-1;
+    if(bin > 0 && val < linspace_edge(bin, range_min, bin_width))
+        bin--;
+    else if(bin < (int) n_bins-1
+            && val >= linspace_edge(bin+1, range_min, bin_width))
+        bin++;
+    return bin;
+}
+
+// Cast n_values doubles to floats, e.g. to create the single precision
+// input from double precision input which is on the device already.
+__global__ void cast_double_to_float(const double *in, const iType n_values,
+    float *out)
+{
+    for(iType i = blockIdx.x*blockDim.x + threadIdx.x; i < n_values;
+        i += blockDim.x*gridDim.x)
+    {
+        out[i] = (float) in[i];
+    }
+}
+
 __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
     const iType no_of_dimensions, fType *d_max, fType *d_min)
 {
-    // First n_elements entries are used for max reduction the last
-    // n_elements entries are used for min reduction.
-    extern __shared__ fType shared[];
-    fType *shared_max = (fType*)shared;
-    fType *shared_min = (fType*)&shared[blockDim.x];
+    // One value per thread for the max and the min reduction.
+    __shared__ fType shared_max[REDUCE_BLOCK_DIM];
+    __shared__ fType shared_min[REDUCE_BLOCK_DIM];
     int tid = threadIdx.x;
     int gid = blockIdx.x * blockDim.x + tid;
 
-    // Init global max and min value. This is a separated loop to avoid
-    // race conditions.
-    for(int d = 0; d < no_of_dimensions; d++)
+    // d_max and d_min are initialized with -inf and inf by the host. Doing
+    // that here would race with blocks that are already done.
+
+    // Each thread keeps the max and min of all dimensions in registers.
+    // Hence the input array is read only once for all dimensions.
+    fType local_max[NO_OF_DIMS];
+    fType local_min[NO_OF_DIMS];
+    #pragma unroll
+    for(int d = 0; d < NO_OF_DIMS; d++)
     {
-        if(gid == 0)
-        {
-            d_max[d] = CUDART_NEG_INF_F;
-            d_min[d] = CUDART_INF_F;
-        }
+        local_max[d] = CUDART_NEG_INF_F;
+        local_min[d] = CUDART_INF_F;
     }
-
-    // Max- and Min-Reduce for each dimension
-    for(int d = 0; d < no_of_dimensions; d++)
+    for(int i = gid; i < n_elements; i += gridDim.x * blockDim.x)
     {
-        // Initialize shared memory with input memory
-        if(gid < n_elements)
+        #pragma unroll
+        for(int d = 0; d < NO_OF_DIMS; d++)
         {
-            shared_max[tid] = d_array[gid*no_of_dimensions+d];
-            shared_min[tid] = d_array[gid*no_of_dimensions+d];
-            gid += gridDim.x * blockDim.x;
+            fType val = d_array[i*NO_OF_DIMS+d];
+            local_max[d] = max(local_max[d], val);
+            local_min[d] = min(local_min[d], val);
         }
+    }
 
-        // Start max reduction in each block with left overs from input array.
-        // If there are more elements than threads, then we copy the next
-        // elements from input if they are bigger/lower than the last copied
-        // values.
-        while(gid < n_elements)
-        {
-            shared_max[tid] = max(shared_max[tid],
-                d_array[gid*no_of_dimensions+d]);
-            shared_min[tid] = min(shared_min[tid],
-                d_array[gid*no_of_dimensions+d]);
-            gid += gridDim.x * blockDim.x;
-        }
+    // Blockwise reduction for each dimension. Threads without any elements
+    // hold -inf and inf which do not change the result.
+    #pragma unroll
+    for(int d = 0; d < NO_OF_DIMS; d++)
+    {
+        shared_max[tid] = local_max[d];
+        shared_min[tid] = local_min[d];
         __syncthreads();
-        gid = blockIdx.x * blockDim.x + threadIdx.x;
-
-        // Blockwise reduction
-        for(int i=blockDim.x/2; i > 0; i >>= 1)
+        #pragma unroll
+        for(int i=REDUCE_BLOCK_DIM/2; i > 0; i >>= 1)
         {
-            // First check: For reduce algorithm
-            // Second check: If there are less elements than threads in one block
-            // do not access out of bounds. Only for "last block" and
-            // n_elements/blockDim.x != 0
-            if(tid < i && gid + i < n_elements)
+            if(tid < i)
             {
                 shared_max[tid] = max(shared_max[tid], shared_max[tid + i]);
                 shared_min[tid] = min(shared_min[tid], shared_min[tid + i]);
@@ -156,7 +268,7 @@ __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
             __syncthreads();
         }
         // Now return max value of all blocks in global memory
-        if(tid == 0 && gid < n_elements)
+        if(tid == 0)
         {
             atomicMaxfType(&d_max[d], shared_max[0]);
             atomicMinfType(&d_min[d], shared_min[0]);
@@ -171,39 +283,40 @@ __global__ void histogram_gmem_atomics(const fType *in,  const iType length,
         const iType no_of_flat_bins, histoType *out, fType *max_in, fType *min_in)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    histoType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += blockDim.x)
-    {
-        gmem[i] = 0;
-    }
-    __syncthreads();
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    histoType *gmem = out;
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i+=no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i+=NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[i + d];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -225,27 +338,21 @@ __global__ void histogram_gmem_atomics_with_edges(const fType *in,
         histoType *out, const fType *edges_in)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    unsigned int threads_per_block = blockDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    histoType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += threads_per_block)
-    {
-        gmem[i] = 0;
-    }
-    __syncthreads();
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    histoType *gmem = out;
 
     // Process input data by updating the histogram of each block in global
     // memory.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-            i += no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+            i += NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[i + d];
             int tmp_bin = 0;
@@ -261,7 +368,7 @@ __global__ void histogram_gmem_atomics_with_edges(const fType *in,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -284,39 +391,40 @@ __global__ void histogram_gmem_atomics_weights(const fType *in,  const iType len
         const fType *weights)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    fType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += blockDim.x)
-    {
-        gmem[i] = 0;
-    }
-    __syncthreads();
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    fType *gmem = out;
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i+=no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i+=NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[i + d];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -325,7 +433,7 @@ __global__ void histogram_gmem_atomics_weights(const fType *in,  const iType len
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAddfType(&gmem[current_bin], weights[i/no_of_dimensions]);
+            atomicAddfType(&gmem[current_bin], weights[i/NO_OF_DIMS]);
         }
     }
 }
@@ -338,27 +446,21 @@ __global__ void histogram_gmem_atomics_with_edges_weights(const fType *in,
         fType *out, const fType *edges_in, const fType *weights)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    unsigned int threads_per_block = blockDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    fType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += threads_per_block)
-    {
-        gmem[i] = 0;
-    }
-    __syncthreads();
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    fType *gmem = out;
 
     // Process input data by updating the histogram of each block in global
     // memory.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-            i += no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+            i += NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[i + d];
             int tmp_bin = 0;
@@ -374,7 +476,7 @@ __global__ void histogram_gmem_atomics_with_edges_weights(const fType *in,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -384,7 +486,7 @@ __global__ void histogram_gmem_atomics_with_edges_weights(const fType *in,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAddfType(&gmem[current_bin], weights[i/no_of_dimensions]);
+            atomicAddfType(&gmem[current_bin], weights[i/NO_OF_DIMS]);
         }
     }
 }
@@ -406,28 +508,35 @@ __global__ void histogram_smem_atomics(const fType *in,  const iType length,
     }
     __syncthreads();
 
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i+=no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i+=NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[i + d];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -436,15 +545,15 @@ __global__ void histogram_smem_atomics(const fType *in,  const iType length,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAdd(&smem2[current_bin], 1);
+            atomicIncBlockAggregated(smem2, current_bin);
         }
     }
     __syncthreads();
-    // Write partial histograms in global memory
-    out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        out[i] = smem2[i];
+        if(smem2[i] != 0) atomicAdd(&out[i], smem2[i]);
     }
 }
 
@@ -469,12 +578,13 @@ __global__ void histogram_smem_atomics_with_edges(const fType *in,
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i += no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i += NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[i + d];
             int tmp_bin = 0;
@@ -490,7 +600,7 @@ __global__ void histogram_smem_atomics_with_edges(const fType *in,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -500,16 +610,16 @@ __global__ void histogram_smem_atomics_with_edges(const fType *in,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAdd(&smem2[current_bin], 1);
+            atomicIncBlockAggregated(smem2, current_bin);
         }
     }
     __syncthreads();
 
-    // Write partial histograms in global memory
-    histoType *overall_out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        overall_out[i] = smem2[i];
+        if(smem2[i] != 0) atomicAdd(&out[i], smem2[i]);
     }
 }
 
@@ -531,28 +641,35 @@ __global__ void histogram_smem_atomics_weights(const fType *in,  const iType len
     }
     __syncthreads();
 
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i+=no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i+=NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[i + d];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -561,15 +678,15 @@ __global__ void histogram_smem_atomics_weights(const fType *in,  const iType len
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-          atomicAddfType(&smem[current_bin], weights[i/no_of_dimensions]);
+          atomicAddfTypeBlock(&smem[current_bin], weights[i/NO_OF_DIMS]);
         }
     }
     __syncthreads();
-    // Write partial histograms in global memory
-    out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        out[i] = smem[i];
+        if(smem[i] != 0) atomicAddfType(&out[i], smem[i]);
     }
 }
 
@@ -594,12 +711,13 @@ __global__ void histogram_smem_atomics_with_edges_weights(const fType *in,
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
-    for(unsigned int i = gid*no_of_dimensions; i < length;
-        i += no_of_dimensions*total_threads)
+    for(unsigned int i = gid*NO_OF_DIMS; i < length;
+        i += NO_OF_DIMS*total_threads)
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[i + d];
             int tmp_bin = 0;
@@ -615,7 +733,7 @@ __global__ void histogram_smem_atomics_with_edges_weights(const fType *in,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -625,58 +743,16 @@ __global__ void histogram_smem_atomics_with_edges_weights(const fType *in,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAddfType(&smem[current_bin], weights[i/no_of_dimensions]);
+            atomicAddfTypeBlock(&smem[current_bin], weights[i/NO_OF_DIMS]);
         }
     }
     __syncthreads();
 
-    // Write partial histograms in global memory
-    fType *overall_out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        overall_out[i] = smem[i];
-    }
-}
-
-__global__ void histogram_final_accum(const histoType *in,
-        const iType no_of_histograms, histoType *out, const iType histo_length)
-{
-    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int total_threads = blockDim.x * gridDim.x;
-    // Each thread merges values for another bin
-    for(unsigned int current_bin = gid; current_bin < histo_length;
-            current_bin += total_threads)
-    {
-        if(current_bin < histo_length)
-        {
-            histoType total = 0;
-            for(unsigned int j = 0; j < no_of_histograms; j++)
-            {
-                total += in[histo_length * j + current_bin];
-            }
-            out[current_bin] = total;
-        }
-    }
-}
-
-__global__ void histogram_final_accum_weights(const fType *in,
-        const iType no_of_histograms, fType *out, const iType histo_length)
-{
-    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int total_threads = blockDim.x * gridDim.x;
-    // Each thread merges values for another bin
-    for(unsigned int current_bin = gid; current_bin < histo_length;
-            current_bin += total_threads)
-    {
-        if(current_bin < histo_length)
-        {
-            fType total = 0;
-            for(unsigned int j = 0; j < no_of_histograms; j++)
-            {
-                total += in[histo_length * j + current_bin];
-            }
-            out[current_bin] = total;
-        }
+        if(smem[i] != 0) atomicAddfType(&out[i], smem[i]);
     }
 }
 
@@ -685,58 +761,49 @@ __global__ void max_min_reduce2(const fType *d_array_x, const iType n_elements,
     const fType *d_array_y, const fType *d_array_z,
     const iType no_of_dimensions, fType *d_max, fType *d_min)
 {
-    // First n_elements entries are used for max reduction the last
-    // n_elements entries are used for min reduction.
-    extern __shared__ fType shared[];
-    fType *shared_max = (fType*)shared;
-    fType *shared_min = (fType*)&shared[blockDim.x];
+    // One value per thread for the max and the min reduction.
+    __shared__ fType shared_max[REDUCE_BLOCK_DIM];
+    __shared__ fType shared_min[REDUCE_BLOCK_DIM];
     int tid = threadIdx.x;
     int gid = blockIdx.x * blockDim.x + tid;
     const fType *d_array[3] = {d_array_x, d_array_y, d_array_z};
 
-    // Init global max and min value. This is a separated loop to avoid
-    // race conditions.
-    for(int d = 0; d < no_of_dimensions; d++)
+    // d_max and d_min are initialized with -inf and inf by the host. Doing
+    // that here would race with blocks that are already done.
+
+    // Each thread keeps the max and min of all dimensions in registers.
+    // Hence the input array is read only once for all dimensions.
+    fType local_max[NO_OF_DIMS];
+    fType local_min[NO_OF_DIMS];
+    #pragma unroll
+    for(int d = 0; d < NO_OF_DIMS; d++)
     {
-        if(gid == 0)
-        {
-            d_max[d] = CUDART_NEG_INF_F;
-            d_min[d] = CUDART_INF_F;
-        }
+        local_max[d] = CUDART_NEG_INF_F;
+        local_min[d] = CUDART_INF_F;
     }
-
-    // Max- and Min-Reduce for each dimension
-    for(int d = 0; d < no_of_dimensions; d++)
+    for(int i = gid; i < n_elements; i += gridDim.x * blockDim.x)
     {
-        // Initialize shared memory with input memory
-        if(gid < n_elements)
+        #pragma unroll
+        for(int d = 0; d < NO_OF_DIMS; d++)
         {
-            shared_max[tid] = d_array[d][gid];
-            shared_min[tid] = d_array[d][gid];
-            gid += gridDim.x * blockDim.x;
+            fType val = d_array[d][i];
+            local_max[d] = max(local_max[d], val);
+            local_min[d] = min(local_min[d], val);
         }
+    }
 
-        // Start max reduction in each block with left overs from input array.
-        // If there are more elements than threads, then we copy the next
-        // elements from input if they are bigger/lower than the last copied
-        // values.
-        while(gid < n_elements)
-        {
-            shared_max[tid] = max(shared_max[tid], d_array[d][gid]);
-            shared_min[tid] = min(shared_min[tid], d_array[d][gid]);
-            gid += gridDim.x * blockDim.x;
-        }
+    // Blockwise reduction for each dimension. Threads without any elements
+    // hold -inf and inf which do not change the result.
+    #pragma unroll
+    for(int d = 0; d < NO_OF_DIMS; d++)
+    {
+        shared_max[tid] = local_max[d];
+        shared_min[tid] = local_min[d];
         __syncthreads();
-        gid = blockIdx.x * blockDim.x + threadIdx.x;
-
-        // Blockwise reduction
-        for(int i=blockDim.x/2; i > 0; i >>= 1)
+        #pragma unroll
+        for(int i=REDUCE_BLOCK_DIM/2; i > 0; i >>= 1)
         {
-            // First check: For reduce algorithm
-            // Second check: If there are less elements than threads in one block
-            // do not access out of bounds. Only for "last block" and
-            // n_elements/blockDim.x != 0
-            if(tid < i && gid + i < n_elements)
+            if(tid < i)
             {
                 shared_max[tid] = max(shared_max[tid], shared_max[tid + i]);
                 shared_min[tid] = min(shared_min[tid], shared_min[tid + i]);
@@ -744,7 +811,7 @@ __global__ void max_min_reduce2(const fType *d_array_x, const iType n_elements,
             __syncthreads();
         }
         // Now return max value of all blocks in global memory
-        if(tid == 0 && gid < n_elements)
+        if(tid == 0)
         {
             atomicMaxfType(&d_max[d], shared_max[0]);
             atomicMinfType(&d_min[d], shared_min[0]);
@@ -760,39 +827,40 @@ __global__ void histogram_gmem_atomics2(const fType *in_x,  const iType length,
         const iType no_of_flat_bins, histoType *out, fType *max_in, fType *min_in)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    histoType *gmem2 = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += blockDim.x)
-    {
-        gmem2[i] = 0;
-    }
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    histoType *gmem2 = out;
     const fType *in[3] = {in_x, in_y, in_z};
-    __syncthreads();
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
     for(unsigned int i = gid; i < length; i+=total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[d][i];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -815,19 +883,12 @@ __global__ void histogram_gmem_atomics_with_edges2(const fType *in_x,
         histoType *out, const fType *edges_in)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    unsigned int threads_per_block = blockDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    histoType *gmem2 = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += threads_per_block)
-    {
-        gmem2[i] = 0;
-    }
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    histoType *gmem2 = out;
     const fType *in[3] = {in_x, in_y, in_z};
-    __syncthreads();
 
     // Process input data by updating the histogram of each block in global
     // memory.
@@ -835,7 +896,8 @@ __global__ void histogram_gmem_atomics_with_edges2(const fType *in_x,
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[d][i];
             int tmp_bin = 0;
@@ -853,7 +915,7 @@ __global__ void histogram_gmem_atomics_with_edges2(const fType *in_x,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -877,39 +939,40 @@ __global__ void histogram_gmem_atomics_weights2(const fType *in_x,
         const fType *weights)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    fType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += blockDim.x)
-    {
-        gmem[i] = 0;
-    }
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    fType *gmem = out;
     const fType *in[3] = {in_x, in_y, in_z};
-    __syncthreads();
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
     for(unsigned int i = gid; i < length; i+=total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[d][i];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -932,19 +995,12 @@ __global__ void histogram_gmem_atomics_with_edges_weights2(const fType *in_x,
         fType *out, const fType *edges_in, const fType *weights)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    unsigned int threads_per_block = blockDim.x;
 
-    // initialize temporary histogram for each block in global memory
-    fType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += threads_per_block)
-    {
-        gmem[i] = 0;
-    }
+    // All blocks add to the same histogram in global memory. It is zeroed
+    // by the host before the launch.
+    fType *gmem = out;
     const fType *in[3] = {in_x, in_y, in_z};
-    __syncthreads();
 
     // Process input data by updating the histogram of each block in global
     // memory.
@@ -952,7 +1008,8 @@ __global__ void histogram_gmem_atomics_with_edges_weights2(const fType *in_x,
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[d][i];
             int tmp_bin = 0;
@@ -968,7 +1025,7 @@ __global__ void histogram_gmem_atomics_with_edges_weights2(const fType *in_x,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -1002,27 +1059,34 @@ __global__ void histogram_smem_atomics2(const fType *in_x,
     const fType *in[3] = {in_x, in_y, in_z};
     __syncthreads();
 
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
     for(unsigned int i = gid; i < length; i+=total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[d][i];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -1031,15 +1095,15 @@ __global__ void histogram_smem_atomics2(const fType *in_x,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAdd(&smem2[current_bin], 1);
+            atomicIncBlockAggregated(smem2, current_bin);
         }
     }
     __syncthreads();
-    // Write partial histograms in global memory
-    out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        out[i] = smem2[i];
+        if(smem2[i] != 0) atomicAdd(&out[i], smem2[i]);
     }
 }
 
@@ -1070,7 +1134,8 @@ __global__ void histogram_smem_atomics_with_edges2(const fType *in_x,
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[d][i];
             int tmp_bin = 0;
@@ -1086,7 +1151,7 @@ __global__ void histogram_smem_atomics_with_edges2(const fType *in_x,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -1096,16 +1161,16 @@ __global__ void histogram_smem_atomics_with_edges2(const fType *in_x,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAdd(&smem2[current_bin], 1);
+            atomicIncBlockAggregated(smem2, current_bin);
         }
     }
     __syncthreads();
 
-    // Write partial histograms in global memory
-    histoType *overall_out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        overall_out[i] = smem2[i];
+        if(smem2[i] != 0) atomicAdd(&out[i], smem2[i]);
     }
 }
 
@@ -1129,27 +1194,34 @@ __global__ void histogram_smem_atomics_weights2(const fType *in_x,
     const fType *in[3] = {in_x, in_y, in_z};
     __syncthreads();
 
+    fType range_min[NO_OF_DIMS];
+    fType range_max[NO_OF_DIMS];
+    fType bin_scale[NO_OF_DIMS];
+    fType bin_width[NO_OF_DIMS];
+    load_bin_ranges(min_in, max_in, no_of_bins, range_min, range_max,
+                    bin_scale, bin_width);
+
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
     // time.
     for(unsigned int i = gid; i < length; i+=total_threads)
     {
         int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins[d];
             fType val = in[d][i];
             // Get the bin in the current dimension
-            if(val < min_in[d] || val > max_in[d])
+            if(val < range_min[d] || val > range_max[d])
             {
                 current_bin = no_of_flat_bins+1;
                 break;
             }
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins[d]) tmp_bin--;
+            int tmp_bin = get_bin(val, range_min[d], bin_scale[d],
+                                  bin_width[d], no_of_bins[d]);
             // Get the right place in the histogram
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -1158,15 +1230,15 @@ __global__ void histogram_smem_atomics_weights2(const fType *in_x,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAddfType(&smem[current_bin], weights[i]);
+            atomicAddfTypeBlock(&smem[current_bin], weights[i]);
         }
     }
     __syncthreads();
-    // Write partial histograms in global memory
-    out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        out[i] = smem[i];
+        if(smem[i] != 0) atomicAddfType(&out[i], smem[i]);
     }
 }
 
@@ -1197,7 +1269,8 @@ __global__ void histogram_smem_atomics_with_edges_weights2(const fType *in_x,
     {
         int current_bin = 0;
         int bins_offset = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        #pragma unroll
+        for(unsigned int d = 0; d < NO_OF_DIMS; d++)
         {
             fType val = in[d][i];
             int tmp_bin = 0;
@@ -1213,7 +1286,7 @@ __global__ void histogram_smem_atomics_with_edges_weights2(const fType *in_x,
                 break;
             }
             int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+            for(unsigned int k=NO_OF_DIMS-1; k > d; k--)
             {
                 power_bins = no_of_bins[k] * power_bins;
             }
@@ -1223,15 +1296,15 @@ __global__ void histogram_smem_atomics_with_edges_weights2(const fType *in_x,
         // Avoid illegal memory access
         if(current_bin < no_of_flat_bins)
         {
-            atomicAddfType(&smem[current_bin], weights[i]);
+            atomicAddfTypeBlock(&smem[current_bin], weights[i]);
         }
     }
     __syncthreads();
 
-    // Write partial histograms in global memory
-    fType *overall_out = &out[blockIdx.x * no_of_flat_bins];
+    // Add the histogram of this block to the overall histogram. Empty bins
+    // are skipped to save atomic operations.
     for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
     {
-        overall_out[i] = smem[i];
+        if(smem[i] != 0) atomicAddfType(&out[i], smem[i]);
     }
 }
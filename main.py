@@ -20,12 +20,17 @@ date:    February 2017
 
 from argparse import (ArgumentParser, RawTextHelpFormatter)
 from collections import OrderedDict
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import csv
 from itertools import product
+import multiprocessing
 import os
 import random as rnd
 import sys
+import tempfile
 from timeit import default_timer as timer
+from types import SimpleNamespace
 import warnings
 
 import matplotlib
@@ -33,145 +38,509 @@ matplotlib.use('agg')
 import matplotlib.gridspec as gridspec
 import matplotlib.lines as mlines
 import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
 import numpy as np
-import pandas as pd
 import pycuda.autoinit
 import pycuda.driver as cuda
+from pycuda.tools import DeviceMemoryPool
 
 import gpu_hist
 from gpu_hist import create_array, create_weights, create_edges
 
+# Numba is optional. Without it the CPU reference for equally spaced bins
+# uses np.bincount.
+try:
+    from numba import get_num_threads, njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
 FTYPE = np.float64
+# pyplot and pandas take long to import and are only needed for plots and
+# --test. pyplot is imported by load_pyplot() and pandas in --test.
+plt = None
+# Timings lookup of plot_timings(), set in each worker by init_timings_worker()
+LOOKUP = None
+
+# Tick labels with two decimals. FormatStrFormatter does not depend on its
+# axis, hence one instance is shared by all axes.
+FMT2 = FormatStrFormatter('%.2f')
+
+def load_pyplot():
+    """Import matplotlib.pyplot on first use. The backend is set to agg
+    at startup."""
+    global plt
+    if plt is None:
+        import matplotlib.pyplot
+        plt = matplotlib.pyplot
+    return plt
+
+
+def record_timing(method, info, timings):
+    """Save the timings into an ordered dictionary. This can be parsed
+    to pandas own dataformat."""
+    # info holds only strings and numbers, a shallow copy is enough
+    new_info = OrderedDict(info)
+    new_info['method'] = method
+    # Sort once and read median, minimum and maximum from the sorted times
+    n_trials = len(timings)
+    t = np.fromiter(timings, dtype=np.float64, count=n_trials)
+    t.sort()
+    new_info['n_trials'] = n_trials
+    new_info['time_median'] = (t[(n_trials-1)//2] + t[n_trials//2]) / 2
+    new_info['time_mean'] = t.mean()
+    new_info['time_min'] = t[0]
+    new_info['time_max'] = t[-1]
+    new_info['time_std'] = t.std()
+    return new_info
+
+
+def free_device_array(d_data):
+    """Free a device array or a list of device arrays created by
+    create_array(). Host arrays are ignored."""
+    if isinstance(d_data, list):
+        for d in d_data:
+            free_device_array(d)
+    elif gpu_hist.is_device_array(d_data):
+        d_data.free()
 
-def mkdir(directory, mode=0o750, warn=True):
-    """Simple wrapper around os.makedirs to create a directory but not raise an
-    exception if the dir already exists
+
+def required_memory(n_dims, n_elements, n_bins, ftype, given_edges,
+                    device_samples):
+    """Return the number of bytes a combination of --test needs on the GPU.
+    One integer is 4 bytes. All blocks add to one histogram. We also take
+    the samples into account (two buffers, plus the buffer get_hist copies
+    samples on the host to) and the edges if they are given and need to be
+    copied."""
+    # histogram
+    n_bytes = n_bins**n_dims*4
+    itemsize = np.dtype(ftype).itemsize
+    # samples
+    n_bytes += 2*n_dims*n_elements*itemsize
+    if not device_samples:
+        n_bytes += n_dims*n_elements*itemsize
+    if given_edges:
+        n_bytes += itemsize*n_bins**n_dims
+    return n_bytes
+
+
+def upload_sample(h_data, d_data, stream):
+    """Copy the host data into the device array or into the list of device
+    arrays with one array per row of `h_data` asynchronously on `stream`."""
+    if isinstance(d_data, list):
+        for h_row, d_row in zip(h_data, d_data):
+            cuda.memcpy_htod_async(d_row, h_row, stream)
+    else:
+        cuda.memcpy_htod_async(d_data, h_data, stream)
+
+
+def select_timings(lookup, key, column):
+    """Return the values of `column` for all rows of `lookup` with the index
+    `key` as a list. The list is empty if there are no such rows.
 
     Parameters
     ----------
-    d : string
-        Directory path
-    mode : integer
-        Permissions on created directory; see os.makedirs for details.
-    warn : bool
-        Whether to warn if directory already exists.
-
+    lookup : DataFrame indexed by (method, ftype, n_dims, n_bins,
+             given_edges, device_samples)
+    key : tuple
+    column : string
     """
     try:
-        os.makedirs(directory, mode=mode)
-    except OSError as err:
-        if err.errno == 17:
-            if warn:
-                print('Directory "%s" already exists' %directory)
+        return lookup.loc[[key], column].tolist()
+    except KeyError:
+        return []
+
+
+if HAVE_NUMBA:
+    # No 'nnan' and 'ninf': with them the range check below may be dropped
+    # and NaN or infinite values would be counted into some bin.
+    @njit(parallel=True, fastmath={'contract', 'arcp', 'reassoc'}, cache=True)
+    def hist_nd(sample, weights, lo, hi, scale, no_of_bins, out):
+        """Count the events of `sample` into equally spaced bins from `lo`
+        to `hi` with `scale` bins per unit. The range check, the scaling and
+        the count are done in one pass. Each thread counts into its own row of
+        `out`, which has to be zeroed and summed over the first axis by the
+        caller. Values outside of the bins are not counted; the last bin
+        includes its right edge. If `weights` is empty, each event adds one
+        to its bin, otherwise its weight."""
+        weighted = weights.shape[0] > 0
+        n_threads = out.shape[0]
+        n_events, n_dims = sample.shape
+        chunk = (n_events + n_threads - 1) // n_threads
+        for t in prange(n_threads):
+            for i in range(t*chunk, min((t+1)*chunk, n_events)):
+                flat = 0
+                for d in range(n_dims):
+                    x = sample[i, d]
+                    if not (x >= lo[d] and x <= hi[d]):
+                        flat = -1
+                        break
+                    j = int((x - lo[d]) * scale[d])
+                    if j >= no_of_bins[d]:
+                        j = no_of_bins[d] - 1
+                    flat = flat*no_of_bins[d] + j
+                if flat >= 0:
+                    if weighted:
+                        out[t, flat] += weights[i]
+                    else:
+                        out[t, flat] += 1
+
+
+def fast_histogramdd_regular(sample, bins, weights=None):
+    """Compute the same histogram as np.histogramdd for equally spaced bins.
+    Each value is scaled to its bin index directly instead of searching the
+    edges and the counts are made with one np.bincount of the flat indices.
+    The parallel hist_nd is used if Numba is installed.
+
+    Parameters
+    ----------
+    sample : (N, D) array
+    bins : int or list of int or (D, B+1) array
+           The number of bins for all dimensions, the number of bins for each
+           dimension or the equally spaced edges of each dimension. Only the
+           first and last edge are used.
+    weights : (N,) array, optional
+
+    Returns
+    -------
+    hist : ndarray
+    edges : list of D arrays
+    """
+    sample = np.asarray(sample)
+    if sample.ndim == 1:
+        sample = sample[:, np.newaxis]
+    n_events, n_dims = sample.shape
+    if weights is not None:
+        # hist_nd does not check the bounds of `weights`
+        weights = np.asarray(weights)
+        if weights.shape != (n_events,):
+            raise ValueError("`weights` must have one entry per event "
+                             "(%d), got shape %s"
+                             % (n_events, weights.shape))
+    if np.ndim(bins) == 0:
+        bins = [bins] * n_dims
+    if np.ndim(bins[0]) == 0:
+        if n_events == 0:
+            # Same range as np.histogramdd for an empty sample
+            lo = np.zeros(n_dims)
+            hi = np.ones(n_dims)
         else:
-            print("Problem creating directory:", err)
+            lo = sample.min(axis=0).astype(np.float64)
+            hi = sample.max(axis=0).astype(np.float64)
+        # Same as np.histogramdd for dimensions with a single value
+        same = lo == hi
+        lo[same] -= 0.5
+        hi[same] += 0.5
+        no_of_bins = [int(b) for b in bins]
+        edges = [np.linspace(lo[d], hi[d], no_of_bins[d]+1)
+                 for d in range(n_dims)]
     else:
-        print('Created directory "%s"' %directory)
+        edges = [np.asarray(e) for e in bins]
+        no_of_bins = [len(e)-1 for e in edges]
+        lo = [float(e[0]) for e in edges]
+        hi = [float(e[-1]) for e in edges]
 
+    n_flat_bins = int(np.prod(no_of_bins))
+    # Numba counts into one histogram per thread. Only worth it if these
+    # are small compared to the sample.
+    if HAVE_NUMBA and get_num_threads() * n_flat_bins <= n_events:
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        scale = np.asarray(no_of_bins, dtype=np.float64) / (hi - lo)
+        no_of_bins_arr = np.asarray(no_of_bins, dtype=np.int64)
+        if weights is None:
+            out = np.zeros((get_num_threads(), n_flat_bins), dtype=np.int64)
+            # No weights are passed as an empty array of the same type
+            weights = np.empty(0, dtype=np.int64)
+        else:
+            out = np.zeros((get_num_threads(), n_flat_bins),
+                           dtype=np.float64)
+            weights = weights.astype(np.float64, copy=False)
+        hist_nd(sample, weights, lo, hi, scale, no_of_bins_arr, out)
+        return out.sum(axis=0).reshape(no_of_bins), edges
 
-def record_timing(method, info, timings):
-    """Save the timings into an ordered dictionary. This can be parsed
-    to pandas own dataformat."""
-    new_info = deepcopy(info)
-    new_info['method'] = method
-    new_info['n_trials'] = len(timings)
-    new_info['time_median'] = np.median(timings)
-    new_info['time_mean'] = np.mean(timings)
-    new_info['time_min'] = np.min(timings)
-    new_info['time_max'] = np.max(timings)
-    new_info['time_std'] = np.std(timings)
-    return new_info
+    flat = np.zeros(n_events, dtype=np.intp)
+    inside = np.ones(n_events, dtype=bool)
+    for d in range(n_dims):
+        x = sample[:, d]
+        # Values outside of the edges are not counted. The last bin
+        # includes its right edge.
+        inside &= (x >= lo[d]) & (x <= hi[d])
+        idx = ((x - lo[d]) * (no_of_bins[d] / (hi[d] - lo[d]))).astype(np.intp)
+        np.clip(idx, 0, no_of_bins[d] - 1, out=idx)
+        flat *= no_of_bins[d]
+        flat += idx
+    if weights is not None:
+        weights = weights[inside]
+    hist = np.bincount(flat[inside], weights=weights, minlength=n_flat_bins)
+    return hist.reshape(no_of_bins), edges
+
+
+def is_equally_spaced(edges_d):
+    """Return True if the edges of one dimension are equally spaced."""
+    widths = np.diff(np.asarray(edges_d, dtype=np.float64))
+    return np.allclose(widths, widths[0])
 
 
-def plot_histogram(histogram, edges, outdir, name, no_of_bins):
-    """Plots the histogram into specified directory. If the path does not exist
-    then it will be created.
+def bins_are_counts(bins):
+    """Return True if `bins` gives numbers of bins, i.e. the edges are
+    computed from the range of the sample, and False if it gives edges."""
+    return np.isscalar(bins) or np.ndim(bins[0]) == 0
+
+
+def widen_edges(edges, ftype):
+    """Return a copy of `edges` with the first and last edge of each
+    dimension moved outward by one step of `ftype`. Events at the boundaries
+    which are rounded to `ftype` then still lie inside the bins.
+
+    Parameters
+    ----------
+    edges : list of arrays
+    ftype : np.float32 or np.float64
+
+    Returns
+    -------
+    edges : list of float64 arrays
+    """
+    lower = ftype(-np.inf)
+    upper = ftype(np.inf)
+    widened = []
+    for edges_d in edges:
+        edges_d = np.array(edges_d, dtype=np.float64)
+        edges_d[0] = np.nextafter(ftype(edges_d[0]), lower)
+        edges_d[-1] = np.nextafter(ftype(edges_d[-1]), upper)
+        widened.append(edges_d)
+    return widened
+
+
+def fast_histogramdd(sample, bins, weights=None):
+    """Same as np.histogramdd(sample, bins=bins, weights=weights) but uses
+    fast_histogramdd_regular if the bins of all dimensions are equally
+    spaced, i.e. if only numbers of bins or equally spaced edges are given.
+    """
+    regular = bins_are_counts(bins)
+    if not regular:
+        regular = all(is_equally_spaced(e) for e in bins)
+    if regular:
+        return fast_histogramdd_regular(sample, bins, weights=weights)
+    return np.histogramdd(sample, bins=bins, weights=weights)
+
+
+def run_case(histogrammer, memory_mode, precision, sample, bins, weights,
+             dims, number_of_events, stream=None):
+    """Calculate one histogram for the plots of main.
+
+    Parameters
+    ----------
+    histogrammer : GPUHist or None
+                   Used for the memory modes 'shared' and 'global'. It must
+                   have been created with the precision of `sample`.
+    memory_mode : 'shared', 'global' or 'cpu'
+    precision : 'double' or 'single' (only used for the title)
+    sample : array or list of device arrays
+             Host array for 'cpu'
+    bins : int, list of ints or edges
+    weights : array or None
+    dims : int
+    number_of_events : int
+    stream : cuda.Stream, optional
+             Passed to GPUHist.get_hist
+
+    Returns
+    -------
+    histogram, edges, title
+    """
+    if memory_mode == 'cpu':
+        histogram, edges = fast_histogramdd(sample, bins=bins,
+                                            weights=weights)
+        return histogram, edges, "CPU, " + precision
+    histogram, edges = histogrammer.get_hist(
+        sample=sample, bins=bins, weights=weights,
+        shared=(memory_mode == 'shared'), dims=dims,
+        number_of_events=number_of_events, stream=stream
+    )
+    return histogram, edges, "GPU %s memory, %s" % (memory_mode, precision)
+
+
+def save_histogram(histogram, edges, outdir, name):
+    """Save the histogram and its edges to outdir/name.npz. The edges of
+    dimension d are stored as edges_d.
 
     Parameters
     ----------
     histogram : array
-    edges : array
+    edges : list of arrays or None
     outdir : path
     name : string
+    """
+    arrays = {'hist': histogram}
+    if edges is not None:
+        for d, edges_d in enumerate(edges):
+            arrays['edges_%d' % d] = np.asarray(edges_d)
+    np.savez_compressed(os.path.join(outdir, name + '.npz'), **arrays)
+
+
+def plot_histograms(entries, outdir, no_of_bins, raw=False, fast=False):
+    """Plots several histograms into the specified directory. All plots are
+    drawn on the same figure which is cleared in between.
+
+    Parameters
+    ----------
+    entries : list of (histogram, edges, name) tuples
+    outdir : path
     no_of_bins : int (length of edges if edges is given)
+    raw : bool, optional
+          If True, the histograms are saved with save_histogram instead
+          of being plotted.
+    fast : bool, optional
+           If True, 2D histograms are written with save_histogram_png
+           instead of matplotlib.
     """
+    if raw:
+        for histogram, edges, name in entries:
+            save_histogram(histogram, edges, outdir, name)
+        return
+    fig = None
+    for histogram, edges, name in entries:
+        if fast and np.ndim(histogram) == 2:
+            save_histogram_png(histogram, outdir, name)
+            continue
+        if fig is None:
+            load_pyplot()
+            fig = plt.figure()
+        plot_histogram(histogram, edges, outdir, name, no_of_bins, fig=fig)
+    if fig is not None:
+        plt.close(fig)
 
-    path = [outdir]
-    mkdir(os.path.join(*path), warn=False)
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    ax.grid(b=True, which='major')
-    ax.grid(b=True, which='minor', linestyle=':')
-
-    if len(np.shape(histogram)) == 1:
-        width = 60
-        if edges is None:
-            edges = np.arange(-360, 360, (720/no_of_bins))
-            ax.bar(edges, histogram, width)
-            ax.set_xticks(edges)
-            ax.set_xticklabels(edges)
-        else:
-            ax.bar(edges[0][0:no_of_bins], histogram, width)
-            ax.set_xticks(edges[0])
-            ax.set_xticklabels(edges[0])
-        ax.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-        for tick in ax.xaxis.get_major_ticks():
-            tick.label.set_fontsize(9)
-        for tick in ax.yaxis.get_major_ticks():
-            tick.label.set_fontsize(9)
-        fig.savefig(outdir+"/"+name)
-    elif len(np.shape(histogram)) == 2:
-        X, Y = np.meshgrid(edges[0], edges[1])
-        plt.pcolormesh(X, Y, np.swapaxes(histogram, 0, 1), cmap='rainbow')
-        cbar = plt.colorbar(orientation='vertical')
-        cbar.ax.tick_params(labelsize=9)
+
+def save_histogram_png(histogram, outdir, name):
+    """Write a 2D histogram as grayscale image to outdir/name.png with Pillow.
+    There are no axes or colorbar; the brightest pixel is the fullest bin.
+    x runs from left to right and y from bottom to top as in plot_histogram.
+
+    Parameters
+    ----------
+    histogram : 2D array
+    outdir : path
+    name : string
+    """
+    from PIL import Image
+    # histogram[x][y] -> rows of y from top to bottom
+    image = np.asarray(histogram, dtype=np.float64).T[::-1]
+    maximum = image.max()
+    if maximum > 0:
+        image = image * (255/maximum)
+    Image.fromarray(image.astype(np.uint8)).save(
+        os.path.join(outdir, name + '.png'))
+
+
+def plot_hist_1d(ax, histogram, edges, no_of_bins):
+    """Draw a 1D histogram as bars on `ax`.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+    histogram : array
+    edges : list with one array or None
+    no_of_bins : int (length of edges if edges is given)
+    """
+    width = 60
+    if edges is None:
+        edges = np.arange(-360, 360, (720/no_of_bins))
+        ax.bar(edges, histogram, width)
+        ax.set_xticks(edges)
+        ax.set_xticklabels(edges)
+    else:
+        ax.bar(edges[0][0:no_of_bins], histogram, width)
         ax.set_xticks(edges[0])
-        ax.set_yticks(edges[1])
-        ax.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-        ax.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-        for tick in ax.xaxis.get_major_ticks():
-            tick.label.set_fontsize(9)
-        for tick in ax.yaxis.get_major_ticks():
-            tick.label.set_fontsize(9)
-        # set the limits of the image
-        plt.axis([X[0][0], X[0][len(X[0])-1], Y[0][0],
-                  Y[len(Y)-1][len(Y[len(Y)-1])-1]])
-        fig.savefig(outdir+"/"+name)
-    elif len(np.shape(histogram)) == 3:
+        ax.set_xticklabels(edges[0])
+    ax.xaxis.set_major_formatter(FMT2)
+    ax.tick_params(axis='both', which='major', labelsize=9)
+
+
+def plot_hist_2d(fig, ax, histogram, edges):
+    """Draw a 2D histogram with a colorbar on `ax`. Equally spaced bins are
+    drawn as one image, other bins as a mesh with one quad per bin.
+
+    Parameters
+    ----------
+    fig : matplotlib.figure.Figure
+          The figure of `ax` which gets the colorbar
+    ax : matplotlib.axes.Axes
+    histogram : 2D array
+    edges : list of arrays (at least two)
+    """
+    # histogram[x][y] -> [y][x] as a view
+    if is_equally_spaced(edges[0]) and is_equally_spaced(edges[1]):
+        image = ax.imshow(histogram.T, origin='lower', aspect='auto',
+                          extent=[edges[0][0], edges[0][-1],
+                                  edges[1][0], edges[1][-1]],
+                          interpolation='nearest', cmap='rainbow')
+    else:
+        X, Y = np.meshgrid(edges[0], edges[1])
+        image = ax.pcolormesh(X, Y, histogram.T, cmap='rainbow')
+    cbar = fig.colorbar(image, ax=ax, orientation='vertical')
+    cbar.ax.tick_params(labelsize=9)
+    ax.set_xticks(edges[0])
+    ax.set_yticks(edges[1])
+    ax.xaxis.set_major_formatter(FMT2)
+    ax.yaxis.set_major_formatter(FMT2)
+    ax.tick_params(axis='both', which='major', labelsize=9)
+    # set the limits of the image
+    ax.axis([edges[0][0], edges[0][-1], edges[1][0], edges[1][-1]])
+
+
+def plot_histogram(histogram, edges, outdir, name, no_of_bins, fig=None):
+    """Plots the histogram into specified directory. The directory must exist;
+    main creates it from --outdir.
+
+    Parameters
+    ----------
+    histogram : array
+    edges : array
+    outdir : path
+    name : string
+    no_of_bins : int (length of edges if edges is given)
+    fig : matplotlib.figure.Figure, optional
+          The figure to draw on. It is cleared first. If None, a new figure
+          is created and closed after saving.
+    """
+    n_dims = np.ndim(histogram)
+    if n_dims > 3:
+        print("Plots are only availale for 3 or less dimensions. Aborting")
+        return
+
+    load_pyplot()
+    own_fig = fig is None
+    if own_fig:
         fig = plt.figure()
-        n_histograms = (len(edges[2])-1)/2
+    else:
+        fig.clf()
+
+    if n_dims < 3:
+        ax = fig.add_subplot(111)
+        ax.grid(visible=True, which='major')
+        ax.grid(visible=True, which='minor', linestyle=':')
+        if n_dims == 1:
+            plot_hist_1d(ax, histogram, edges, no_of_bins)
+        else:
+            plot_hist_2d(fig, ax, histogram, edges)
+    else:
+        n_histograms = (len(edges[2])-1)//2
         if (len(edges[2])-1)%2 != 0:
             n_histograms = n_histograms+1
-        # histogram[x][y][z] -> [z][y][x]
-        histogram = np.swapaxes(histogram, 0, 2)
-        for i in range(0, len(histogram)):
+        for i in range(0, histogram.shape[2]):
             title = ('z: ' + '{:06.2f}'.format(edges[2][i]) + " to "
                      + '{:06.2f}'.format(edges[2][i+1]))
             ax = fig.add_subplot(n_histograms, 2, i+1)
             ax.set_title(title, fontsize=9)
-            ax.grid(b=True, which='major')
-            ax.grid(b=True, which='minor', linestyle=':')
-            X, Y = np.meshgrid(edges[0], edges[1])
-            tmp_histogram = histogram[i][:][:]
-            plt.pcolormesh(X, Y, tmp_histogram, cmap='rainbow')
-            cbar = plt.colorbar(orientation='vertical')
-            cbar.ax.tick_params(labelsize=9)
-            ax.set_xticks(edges[0])
-            ax.set_yticks(edges[1])
-            ax.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-            ax.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-            for tick in ax.xaxis.get_major_ticks():
-                tick.label.set_fontsize(9)
-            for tick in ax.yaxis.get_major_ticks():
-                tick.label.set_fontsize(9)
-            # set the limits of the image
-            plt.axis([X[0][0], X[0][len(X[0])-1], Y[0][0], Y[len(Y)-1][len(Y[len(Y)-1])-1]])
+            ax.grid(visible=True, which='major')
+            ax.grid(visible=True, which='minor', linestyle=':')
+            plot_hist_2d(fig, ax, histogram[:, :, i], edges)
         fig.tight_layout()
-        fig.savefig(outdir+"/"+name)
-    else:
-        print("Plots are only availale for 3 or less dimensions. Aborting")
+    fig.savefig(os.path.join(outdir, name))
+    if own_fig:
+        plt.close(fig)
 
 
 def plot_timings(df, outdir, name):
@@ -183,135 +552,139 @@ def plot_timings(df, outdir, name):
             [precision] single_precision, double_precision
             [Code] CPU, GPU_global, GPU_shared
     """
-    path = [outdir]
-    mkdir(os.path.join(*path), warn=False)
     width = 1.0
     n_dims = df['n_dims'].max()
     min_dims = df['n_dims'].min()
-    n_bins = np.log10(df['n_bins'].max())
-    all_bins = np.logspace(1, n_bins, n_bins, dtype=int)
+    # Powers of ten from 10 up to the largest number of bins
+    all_bins = (10 ** np.arange(
+        1, int(round(np.log10(df['n_bins'].max()))) + 1)).astype(int)
     preallocated = [True, False]
+    # Index the timings once instead of masking the whole frame per query.
+    # Rows with the same index stay sorted by the number of elements.
+    lookup = (df.sort_values(by='n_elements', kind='mergesort')
+              .set_index(['method', 'ftype', 'n_dims', 'n_bins',
+                          'given_edges', 'device_samples'])
+              .sort_index(kind='mergesort'))
+
+    # Only the timings and the number of elements are needed for the
+    # figures. The lookup is sent once to each worker, not with every figure.
+    lookup = lookup[['time_mean', 'n_elements']]
+    params = [(p, d, b, outdir, name, width)
+              for p, d, b in product(preallocated,
+                                     range(min_dims, n_dims+1), all_bins)]
+    # The figures are independent of each other.
+    # Fork explicitly: with spawn or forkserver each worker would import
+    # this module again and create its own CUDA context. The forked workers
+    # only draw with matplotlib and never touch CUDA, which is safe even
+    # though the parent has initialised it.
+    pool = multiprocessing.get_context('fork').Pool(
+        initializer=init_timings_worker, initargs=(lookup,))
+    try:
+        for _ in pool.imap_unordered(make_fig, params):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+
+def init_timings_worker(lookup):
+    """Store the timings lookup of plot_timings() in a worker process.
+
+    Parameters
+    ----------
+    lookup : DataFrame indexed by (method, ftype, n_dims, n_bins,
+             given_edges, device_samples)
+    """
+    global LOOKUP
+    LOOKUP = lookup
+
+
+def make_fig(params):
+    """Create and save the figure of plot_timings() for one combination of
+    preallocated device arrays, dimensions and number of bins.
+
+    Parameters
+    ----------
+    params : tuple
+             (p, d, b, outdir, name, width). The timings are read from
+             LOOKUP, see init_timings_worker().
+    """
+    p, d, b, outdir, name, width = params
+    lookup = LOOKUP
+    load_pyplot()
     given_edges = [True, False]
+    # We start with single precision and subject to number of elements
+    # We compare the speed with given edges and without
+    fig = plt.figure()
+    no_subplots = True
+    gs = gridspec.GridSpec(4, 2, width_ratios=[1, 1],
+                           height_ratios=[0.5, 40, 40, 0.1])
+    if p:
+        plot_title = ('Histogram: Speedup and runtime with CPU and'
+                      ' GPU (' + str(d) + 'D)\n'
+                      'using already allocated device arrays')
+    else:
+        plot_title = ('Histogram: Speedup and runtime with CPU and'
+                      ' GPU (' + str(d) + 'D)')
+    plt.suptitle(plot_title, fontsize=16)
 
-    # Loop over: Preallocated memory or not
-    for p in preallocated:
-        # For each dimension
-        for d in xrange(min_dims, n_dims+1):
-            # Count how many rows of plots have been created
-            # For each bin_number
-            for b in all_bins:
-                # We start with single precision and subject to number of elements
-                # We compare the speed with given edges and without
-                fig = plt.figure()
-                no_subplots = True
-                gs = gridspec.GridSpec(4, 2, width_ratios=[1, 1],
-                                       height_ratios=[0.5, 40, 40, 0.1])
-                if p:
-                    plot_title = ('Histogram: Speedup and runtime with CPU and'
-                                  ' GPU (' + str(d) + 'D)\n'
-                                  'using already allocated device arrays')
-                else:
-                    plot_title = ('Histogram: Speedup and runtime with CPU and'
-                                  ' GPU (' + str(d) + 'D)')
-                plt.suptitle(plot_title, fontsize=16)
-
-                for e in given_edges:
-                    # plots x-axis: n_elements, y_axis1: timings, y_axis2: speedup
-                    if e:
-                        ax_f = plt.subplot(gs[4])
-                    else:
-                        ax_f = plt.subplot(gs[2])
-                    seq_time_f = (df.loc[(df['method'] == 'cpu')
-                                         & (df['ftype'] == 'float32')
-                                         & (df['n_dims'] == d)
-                                         & (df['n_bins'] == b)
-                                         & (df['given_edges'] == e)
-                                         & (df['device_samples'] == p)]
-                                  ['time_mean'].tolist())
-                    time_global_f = (df.loc[(df['method'] == 'gpu_global')
-                                            & (df['ftype'] == 'float32')
-                                            & (df['n_dims'] == d)
-                                            & (df['n_bins'] == b)
-                                            & (df['given_edges'] == e)
-                                            & (df['device_samples'] == p)]
-                                     ['time_mean'].tolist())
-                    time_shared_f = (df.loc[(df['method'] == 'gpu_shared')
-                                            & (df['ftype'] == 'float32')
-                                            & (df['n_dims'] == d)
-                                            & (df['n_bins'] == b)
-                                            & (df['given_edges'] == e)
-                                            & (df['device_samples'] == p)]
-                                     ['time_mean'].tolist())
-                    n_elements_f = (df.loc[(df['method'] == 'cpu')
-                                           & (df['ftype'] == 'float32')
-                                           & (df['n_dims'] == d)
-                                           & (df['n_bins'] == b)
-                                           & (df['given_edges'] == e)
-                                           & (df['device_samples'] == p)]
-                                    ['n_elements'].tolist())
-                    if seq_time_f:
-                        no_subplots = False
-                        create_subfig(seq_time_f, time_global_f,
-                                      time_shared_f,
-                                      np.asarray(n_elements_f), ax_f,
-                                      width, 'Number of elements', '(SP)', e, b)
-                    # Next double precision
-                    # plots x-axis: n_elements, y_axis1: timings, y_axis2: speedup
-                    if e:
-                        ax_d = plt.subplot(gs[5])
-                    else:
-                        ax_d = plt.subplot(gs[3])
-                    seq_time_d = (df.loc[(df['method'] == 'cpu')
-                                         & (df['ftype'] == 'float64')
-                                         & (df['n_dims'] == d)
-                                         & (df['n_bins'] == b)
-                                         & (df['given_edges'] == e)
-                                         & (df['device_samples'] == p)]
-                                  ['time_mean'].tolist())
-                    time_global_d = (df.loc[(df['method'] == 'gpu_global')
-                                            & (df['ftype'] == 'float64')
-                                            & (df['n_dims'] == d)
-                                            & (df['n_bins'] == b)
-                                            & (df['given_edges'] == e)
-                                            & (df['device_samples'] == p)]
-                                     ['time_mean'].tolist())
-                    time_shared_d = (df.loc[(df['method'] == 'gpu_shared')
-                                            & (df['ftype'] == 'float64')
-                                            & (df['n_dims'] == d)
-                                            & (df['n_bins'] == b)
-                                            & (df['given_edges'] == e)
-                                            & (df['device_samples'] == p)]
-                                     ['time_mean'].tolist())
-                    n_elements_d = (df.loc[(df['method'] == 'cpu')
-                                           & (df['ftype'] == 'float64')
-                                           & (df['n_dims'] == d)
-                                           & (df['n_bins'] == b)
-                                           & (df['given_edges'] == e)
-                                           & (df['device_samples'] == p)]
-                                    ['n_elements'].tolist())
-                    if seq_time_d:
-                        no_subplots = False
-                        create_subfig(seq_time_d, time_global_d,
-                                      time_shared_d,
-                                      np.asarray(n_elements_d), ax_d,
-                                      width, 'Number of elements', '(DP)', e, b)
-
-                    with warnings.catch_warnings():
-                        # This raises warnings since tight layout cannot
-                        # handle gridspec automatically. We are going to
-                        # do that manually so we can filter the warning.
-                        if seq_time_d:
-                            warnings.simplefilter("ignore", UserWarning)
-                            gs.tight_layout(fig)
-                if p:
-                    fig_name = (outdir+"/n_dims_"+str(d)+"_n_bins_"+str(b)
+    for e in given_edges:
+        # plots x-axis: n_elements, y_axis1: timings, y_axis2: speedup
+        if e:
+            ax_f = plt.subplot(gs[4])
+        else:
+            ax_f = plt.subplot(gs[2])
+        seq_time_f = select_timings(
+            lookup, ('cpu', 'float32', d, b, e, p), 'time_mean')
+        time_global_f = select_timings(
+            lookup, ('gpu_global', 'float32', d, b, e, p), 'time_mean')
+        time_shared_f = select_timings(
+            lookup, ('gpu_shared', 'float32', d, b, e, p), 'time_mean')
+        n_elements_f = select_timings(
+            lookup, ('cpu', 'float32', d, b, e, p), 'n_elements')
+        if seq_time_f:
+            no_subplots = False
+            create_subfig(seq_time_f, time_global_f,
+                          time_shared_f,
+                          np.asarray(n_elements_f), ax_f,
+                          width, 'Number of elements', '(SP)', e, b)
+        # Next double precision
+        # plots x-axis: n_elements, y_axis1: timings, y_axis2: speedup
+        if e:
+            ax_d = plt.subplot(gs[5])
+        else:
+            ax_d = plt.subplot(gs[3])
+        seq_time_d = select_timings(
+            lookup, ('cpu', 'float64', d, b, e, p), 'time_mean')
+        time_global_d = select_timings(
+            lookup, ('gpu_global', 'float64', d, b, e, p), 'time_mean')
+        time_shared_d = select_timings(
+            lookup, ('gpu_shared', 'float64', d, b, e, p), 'time_mean')
+        n_elements_d = select_timings(
+            lookup, ('cpu', 'float64', d, b, e, p), 'n_elements')
+        if seq_time_d:
+            no_subplots = False
+            create_subfig(seq_time_d, time_global_d,
+                          time_shared_d,
+                          np.asarray(n_elements_d), ax_d,
+                          width, 'Number of elements', '(DP)', e, b)
+
+        with warnings.catch_warnings():
+            # This raises warnings since tight layout cannot
+            # handle gridspec automatically. We are going to
+            # do that manually so we can filter the warning.
+            if seq_time_d:
+                warnings.simplefilter("ignore", UserWarning)
+                gs.tight_layout(fig)
+    if p:
+        fig_name = os.path.join(outdir, "n_dims_"+str(d)+"_n_bins_"+str(b)
                                 +"_with-device-samples_"+name)
-                else:
-                    fig_name = (outdir+"/n_dims_"+str(d)+"_n_bins_"+str(b)
+    else:
+        fig_name = os.path.join(outdir, "n_dims_"+str(d)+"_n_bins_"+str(b)
                                 +"_"+name)
-                if not no_subplots:
-                    plt.savefig(fig_name, dpi=600)
-                plt.close(fig)
+    if not no_subplots:
+        plt.savefig(fig_name, dpi=600)
+    plt.close(fig)
 
 
 def create_subfig(seq_time1, running_time1_global, running_time1_shared,
@@ -327,23 +700,20 @@ def create_subfig(seq_time1, running_time1_global, running_time1_shared,
         plot_title = (title + " with " + "{:.0E}".format(amount) + " bins\n"
                       + "and no given edges")
     ax1.set_title(plot_title, fontsize=10)
-    ax1.grid(b=True, which='major')
-    ax1.xaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-    ax1.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
+    ax1.grid(visible=True, which='major')
+    ax1.xaxis.set_major_formatter(FMT2)
+    ax1.yaxis.set_major_formatter(FMT2)
 
     ax1.set_xscale('log')
     ax1.set_yscale('log')
     ax1_speedup = ax1.twinx()
     ax1_speedup.set_yscale('log')
-    speedup1_global = []
-    for i in range(0, len(running_time1_global)):
-        speedup1_global.append(seq_time1[i]/running_time1_global[i])
-    speedup1_shared = []
-    for i in range(0, len(running_time1_shared)):
-        speedup1_shared.append(seq_time1[i]/running_time1_shared[i])
-    width_list = []
-    for n in n_elements:
-        width_list.append(n/3 * width)
+    seq_time1 = np.asarray(seq_time1)
+    running_time1_global = np.asarray(running_time1_global)
+    running_time1_shared = np.asarray(running_time1_shared)
+    speedup1_global = seq_time1/running_time1_global
+    speedup1_shared = seq_time1/running_time1_shared
+    width_list = n_elements/3.0 * width
     ax1_speedup.plot(n_elements, speedup1_global,
                      color='black', marker="x",
                      label='Speedup with global memory')
@@ -378,12 +748,8 @@ def create_subfig(seq_time1, running_time1_global, running_time1_shared,
     ax1.set_xlabel(x_name, fontsize=8)
     ax1.set_ylabel('Running time in seconds', fontsize=8)
     ax1_speedup.set_ylabel('Speedup compared to CPU version', fontsize=8)
-    for tick in ax1.xaxis.get_major_ticks():
-        tick.label.set_fontsize(9)
-    for tick in ax1.yaxis.get_major_ticks():
-        tick.label.set_fontsize(9)
-    for label in ax1_speedup.yaxis.get_majorticklabels():
-        label.set_fontsize(9)
+    ax1.tick_params(axis='both', which='major', labelsize=9)
+    ax1_speedup.tick_params(axis='y', which='major', labelsize=9)
     plt.xlim(n_elements[0]-width_list[0]*2,
              n_elements[len(n_elements)-1]+width_list[len(width_list)-1]*2)
 
@@ -479,6 +845,17 @@ if __name__ == '__main__':
         they don't exist, the script will make them, including
         all subdirectories. If none is supplied no plots will
         be saved.''')
+    parser.add_argument(
+        '--raw', action='store_true',
+        help=
+        '''Save the histograms and their edges as *.npz files to the
+        directory given with `--outdir` instead of plotting them.''')
+    parser.add_argument(
+        '--fast-plots', action='store_true',
+        help=
+        '''Write 2D histograms as plain grayscale *.png images with Pillow
+        instead of plotting them with matplotlib. This is much faster but
+        the images have no axes.''')
     parser.add_argument(
         '--test', action='store_true',
         help=
@@ -490,7 +867,7 @@ if __name__ == '__main__':
         ftype = np.float32
 
     if args.outdir is not None:
-        mkdir(args.outdir, warn=False)
+        os.makedirs(args.outdir, mode=0o750, exist_ok=True)
 
     weights = None
     d_weights = None
@@ -504,7 +881,65 @@ if __name__ == '__main__':
                                             n_dims=args.dims,
                                             device_array=args.device_data,
                                             ftype=ftype,
-                                            list_array=args.list_data)
+                                            list_array=args.list_data,
+                                            pinned=True)
+    # Which histograms to calculate. --full runs all of them but the numpy
+    # histograms are only used for the plots unless --cpu is set.
+    gpu_modes = []
+    if args.gpu_shared or args.gpu_both or args.full:
+        gpu_modes.append('shared')
+    if args.gpu_global or args.gpu_both or args.full:
+        gpu_modes.append('global')
+    run_cpu = args.cpu or (args.full and args.outdir is not None)
+
+    # Created only if events or weights are cast on the device
+    single_histogrammer = None
+    cast_buffers = []
+    if args.full or args.all_precisions:
+        # The single precision runs use the same events as the double
+        # precision runs. Events on the device are cast there and do not
+        # need to be copied again. The cast is queued on its own stream
+        # without waiting for it, hence it can overlap with the double
+        # precision runs. The single precision histograms are computed on
+        # the same stream, after the cast, by the histogrammer which casts
+        # them. Events on the host are only converted on the host; get_hist
+        # uploads them during the single precision runs, without overlap.
+        single_stream = cuda.Stream()
+        input_data_s = input_data.astype(np.float32)
+        if isinstance(d_input_data, list):
+            d_input_list = d_input_data
+        else:
+            d_input_list = [d_input_data]
+        # The cast events are only needed for the GPU runs
+        if gpu_modes and gpu_hist.is_device_array(d_input_list[0]):
+            single_histogrammer = gpu_hist.GPUHist(ftype=np.float32)
+            n_values = input_data_s.size // len(d_input_list)
+            d_input_data_s = []
+            for d_data in d_input_list:
+                d_input_data_s.append(cuda.mem_alloc(n_values * 4))
+                cast_buffers.append(d_input_data_s[-1])
+                single_histogrammer.cast_f64_to_f32(
+                    d_data, d_input_data_s[-1], n_values, stream=single_stream)
+            if not isinstance(d_input_data, list):
+                d_input_data_s = d_input_data_s[0]
+        else:
+            d_input_data_s = input_data_s
+        # The weights are cast the same way. get_hist would cast weights on
+        # the host to single precision on every call and cannot cast them on
+        # the device at all.
+        weights_s = None
+        d_weights_s = None
+        if args.weights:
+            weights_s = weights.astype(np.float32)
+            d_weights_s = weights_s
+            if gpu_modes and gpu_hist.is_device_array(d_weights):
+                if single_histogrammer is None:
+                    single_histogrammer = gpu_hist.GPUHist(ftype=np.float32)
+                d_weights_s = cuda.mem_alloc(weights_s.nbytes)
+                cast_buffers.append(d_weights_s)
+                single_histogrammer.cast_f64_to_f32(
+                    d_weights, d_weights_s, weights_s.size,
+                    stream=single_stream)
     edges = None
     if args.use_given_edges:
         edges = create_edges(n_bins=args.bins, n_dims=args.dims,
@@ -515,157 +950,192 @@ if __name__ == '__main__':
             args.bins = 6
         edges = []
         for i in range(0, args.dims):
-            edges.append(rnd.randint(args.bins/2, 3*args.bins/2))
+            edges.append(rnd.randint(args.bins//2, 3*args.bins//2))
     elif edges is None:
         edges = args.bins
 
     if args.test:
+        import pandas as pd
         n_trials = 10
-        timings = []
+        # Number of different input arrays which are used in turn
+        n_rotate = 2
+        name = "Speedup_test_"
+        # The timings are written to the csv file as soon as they are
+        # measured. Without --outdir a temporary file is used.
+        if args.outdir is not None:
+            csv_file = open(os.path.join(args.outdir, name + '.csv'), 'w+')
+        else:
+            csv_file = tempfile.TemporaryFile(mode='w+')
+        writer = csv.DictWriter(csv_file, fieldnames=[
+            'ftype', 'n_dims', 'n_elements', 'n_bins', 'device_samples',
+            'given_edges', 'method', 'n_trials', 'time_median', 'time_mean',
+            'time_min', 'time_max', 'time_std'])
+        writer.writeheader()
 
         all_dims = [1, 2, 3]
-        all_elements = np.logspace(5, 9, 5)
-        all_bins = np.logspace(1, 4, 4)
+        all_elements = [int(n) for n in np.logspace(5, 9, 5)]
+        all_bins = [10, 100, 1000, 10000]
         all_ftypes = [np.float32, np.float64]
         all_device_samples = [False, True]
         all_given_edges = [False, True]
-        gpu_attributes = cuda.Device(0).get_attributes()
-        max_threads_per_block = gpu_attributes.get(
-            cuda.device_attribute.MAX_THREADS_PER_BLOCK
-        )
-
-        for n_dims, n_elements, n_bins, ftype, device_samples, given_edges in product(
-                all_dims, all_elements, all_bins, all_ftypes,
-                all_device_samples, all_given_edges):
-            n_elements = int(n_elements)
-            n_bins = int(n_bins)
-            # Check if everything fits on the GPU. Continue if it is not the case.
-            # One integer is 4 bytes. We need to know how many blocks there are
-            # with their own histogram. We also take the samples into account
-            # and the edges if they are given and need to be copied.
-            dx, mx = divmod(n_elements, max_threads_per_block)
-            grid_dim = dx + (mx > 0)
-            # local histograms
-            n_bytes = n_bins**n_dims*grid_dim*4
-
-            if ftype == np.float32:
-                # samples
-                n_bytes += n_dims*n_elements*4
-                if given_edges:
-                    n_bytes += 4*n_bins**n_dims
-            else:
-                # samples
-                n_bytes += n_dims*n_elements*8
-                if given_edges:
-                    n_bytes += 8*n_bins**n_dims
-            available_memory = cuda.mem_get_info()[0]
-            if n_bytes > available_memory:
-                continue
-
-            info = OrderedDict([
-                ('ftype', ftype.__name__),
-                ('n_dims', n_dims),
-                ('n_elements', n_elements),
-                ('n_bins', n_bins),
-                ('device_samples', device_samples),
-                ('given_edges', given_edges)
-            ])
-
-            # CPU
-            tmp_timings = []
-            for i in xrange(n_trials):
-                # Create test data inside the loop to avoid caching
-                input_data, d_input_data = create_array(
-                    n_elements=n_elements,
-                    n_dims=n_dims,
-                    device_array=False,
-                    ftype=ftype,
-                    list_array=args.list_data
-                )
+        # Nothing else runs on the GPU, hence the free memory is queried once.
+        # The memory pools hand their held blocks back to the driver whenever
+        # the test data changes such that this stays available.
+        available_memory = cuda.mem_get_info()[0]
+
+        # The histogrammers are exited even if a combination fails
+        with ExitStack() as stack:
+            # Device arrays of all combinations are recycled through one pool
+            # and each precision uses one histogrammer for all combinations.
+            mem_pool = DeviceMemoryPool()
+            histogrammers = dict(
+                (f, stack.enter_context(gpu_hist.GPUHist(ftype=f)))
+                for f in all_ftypes)
+            # The trials alternate between two streams with one device buffer
+            # each. While a trial runs on one stream, the data of the next trial
+            # is uploaded from page-locked memory on the other one. Events on
+            # the stream of a trial measure its time.
+            streams = [cuda.Stream(), cuda.Stream()]
+            start_event = cuda.Event()
+            end_event = cuda.Event()
+            # Test data of the current precision, dimension and number of
+            # elements. It is shared by all combinations of bins and edges.
+            data_key = None
+            host_data = None
+            upload_data = None
+            d_input_data = None
+
+            # Only combinations which fit on the GPU are tested
+            combinations = product(all_dims, all_elements, all_ftypes, all_bins,
+                                   all_device_samples, all_given_edges)
+            feasible = [(d, n, f, b, p, e) for d, n, f, b, p, e in combinations
+                        if required_memory(d, n, b, f, e, p or args.list_data)
+                        <= available_memory]
+
+            for n_dims, n_elements, ftype, n_bins, device_samples, given_edges in feasible:
+                info = OrderedDict([
+                    ('ftype', ftype.__name__),
+                    ('n_dims', n_dims),
+                    ('n_elements', n_elements),
+                    ('n_bins', n_bins),
+                    ('device_samples', device_samples),
+                    ('given_edges', given_edges)
+                ])
+
                 edges = None
                 if given_edges:
                     edges = create_edges(n_bins=n_bins, n_dims=n_dims,
                                          random=False, ftype=ftype)
                 else:
                     edges = n_bins
+                # The arguments of get_hist which are the same for all trials
+                cfg = SimpleNamespace(bins=edges, dims=n_dims,
+                                      number_of_events=n_elements)
 
-                start = timer()
-                histogram_d_numpy, edges_d = np.histogramdd(
-                    input_data, bins=edges, weights=weights
-                )
-                end = timer()
-                tmp_timings.append(end - start)
-                if isinstance(d_input_data, cuda.DeviceAllocation):
-                    d_input_data.free()
-            timings.append(
-                record_timing(method='cpu', info=info, timings=tmp_timings)
-            )
-
-            # GPU global memory
-            tmp_timings = []
-            with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-                for i in xrange(n_trials):
-                    # Create test data inside the loop to avoid caching
-                    input_data, d_input_data = create_array(
-                        n_elements=n_elements,
-                        n_dims=n_dims,
-                        device_array=device_samples,
-                        ftype=ftype,
-                        list_array=args.list_data
-                    )
-                    edges = None
-                    if given_edges:
-                        edges = create_edges(n_bins=n_bins, n_dims=n_dims,
-                                             random=False, ftype=ftype)
+                if data_key != (ftype, n_dims, n_elements):
+                    # Create the test data in page-locked memory. The trials
+                    # alternate between n_rotate arrays to avoid caching. Each
+                    # GPU trial copies its array to the device buffer of its
+                    # stream.
+                    free_device_array(d_input_data)
+                    mem_pool.free_held()
+                    for histogrammer in histogrammers.values():
+                        histogrammer.pool.free_held()
+                    data_key = (ftype, n_dims, n_elements)
+                    host_data = [create_array(n_elements=n_elements,
+                                              n_dims=n_dims, device_array=False,
+                                              ftype=ftype, list_array=False,
+                                              seed=k, pinned=True)[0]
+                                 for k in range(n_rotate)]
+                    if args.list_data and n_dims < 4:
+                        # One device array per dimension
+                        upload_data = [gpu_hist.to_pagelocked(h.T)
+                                       for h in host_data]
+                        d_input_data = [[mem_pool.allocate(row.nbytes)
+                                         for row in upload_data[0]]
+                                        for _ in streams]
                     else:
-                        edges = n_bins
+                        upload_data = host_data
+                        d_input_data = [mem_pool.allocate(host_data[0].nbytes)
+                                        for _ in streams]
 
+                # CPU
+                tmp_timings = []
+                for i in range(n_trials):
+                    input_data = host_data[i % n_rotate]
                     start = timer()
-                    histogram_gpu_global, edges_gpu_global = histogrammer.get_hist(
-                        sample=d_input_data, bins=edges, shared=False,
-                        dims=n_dims, number_of_events=n_elements
+                    # The bins are equally spaced in all tests. The GPU
+                    # histograms are not weighted either.
+                    histogram_d_numpy, edges_d = fast_histogramdd_regular(
+                        input_data, bins=edges
                     )
                     end = timer()
                     tmp_timings.append(end - start)
-                    if isinstance(d_input_data, cuda.DeviceAllocation):
-                        d_input_data.free()
-            timings.append(
-                record_timing(method='gpu_global', info=info, timings=tmp_timings)
-            )
-
-            # GPU shared memory
-            tmp_timings = []
-            with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-                for i in xrange(n_trials):
-                    # Create test data inside the loop to avoid caching
-                    input_data, d_input_data = create_array(
-                        n_elements=n_elements,
-                        n_dims=n_dims,
-                        device_array=device_samples,
-                        ftype=ftype,
-                        list_array=args.list_data
-                    )
-                    edges = None
-                    if given_edges:
-                        edges = create_edges(n_bins=n_bins, n_dims=n_dims,
-                                             random=False, ftype=ftype)
+                writer.writerow(
+                    record_timing(method='cpu', info=info, timings=tmp_timings)
+                )
+
+                histogrammer = histogrammers[ftype]
+                use_device_data = device_samples or args.list_data
+
+                # GPU global memory
+                tmp_timings = []
+                if use_device_data:
+                    upload_sample(upload_data[0], d_input_data[0], streams[0])
+                for i in range(n_trials):
+                    stream = streams[i % 2]
+                    if use_device_data:
+                        sample = d_input_data[i % 2]
+                        if i + 1 < n_trials:
+                            upload_sample(upload_data[(i+1) % n_rotate],
+                                          d_input_data[(i+1) % 2],
+                                          streams[(i+1) % 2])
                     else:
-                        edges = n_bins
+                        sample = host_data[i % n_rotate]
+                    # The event starts after the upload for this trial
+                    start_event.record(stream)
+                    histogram_gpu_global, edges_gpu_global = histogrammer.get_hist(
+                        sample=sample, shared=False, stream=stream, **vars(cfg)
+                    )
+                    end_event.record(stream)
+                    end_event.synchronize()
+                    # time_till returns milliseconds
+                    tmp_timings.append(start_event.time_till(end_event) / 1e3)
+                writer.writerow(
+                    record_timing(method='gpu_global', info=info, timings=tmp_timings)
+                )
 
-                    start = timer()
+                # GPU shared memory
+                tmp_timings = []
+                if use_device_data:
+                    upload_sample(upload_data[0], d_input_data[0], streams[0])
+                for i in range(n_trials):
+                    stream = streams[i % 2]
+                    if use_device_data:
+                        sample = d_input_data[i % 2]
+                        if i + 1 < n_trials:
+                            upload_sample(upload_data[(i+1) % n_rotate],
+                                          d_input_data[(i+1) % 2],
+                                          streams[(i+1) % 2])
+                    else:
+                        sample = host_data[i % n_rotate]
+                    # The event starts after the upload for this trial
+                    start_event.record(stream)
                     histogram_gpu_shared, edges_gpu_shared = histogrammer.get_hist(
-                        sample=d_input_data, bins=edges, shared=True,
-                        dims=n_dims, number_of_events=n_elements
+                        sample=sample, shared=True, stream=stream, **vars(cfg)
                     )
-                    end = timer()
-                    tmp_timings.append(end - start)
-                    if isinstance(d_input_data, cuda.DeviceAllocation):
-                        d_input_data.free()
-            timings.append(
-                record_timing(method='gpu_shared', info=info, timings=tmp_timings)
-            )
-        name = "Speedup_test_"
-        df = pd.DataFrame(timings)
+                    end_event.record(stream)
+                    end_event.synchronize()
+                    # time_till returns milliseconds
+                    tmp_timings.append(start_event.time_till(end_event) / 1e3)
+                writer.writerow(
+                    record_timing(method='gpu_shared', info=info, timings=tmp_timings)
+                )
+                csv_file.flush()
+            free_device_array(d_input_data)
+        csv_file.seek(0)
+        df = pd.read_csv(csv_file)
+        csv_file.close()
         df.sort_values(by=['ftype', 'n_dims', 'n_elements', 'n_bins',
                            'method'], inplace=True)
         pd.set_option('display.max_rows', 500)
@@ -673,234 +1143,65 @@ if __name__ == '__main__':
         pd.set_option('display.width', 1000)
         print(df)
         if args.outdir is not None:
-            df.to_csv(os.path.join(args.outdir, name + '.csv'))
             plot_timings(df, args.outdir, name)
         sys.exit()
 
-    if args.full:
-        # First with double precision
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_d_gpu_shared, edges_d_gpu_shared = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                dims=args.dims, number_of_events=args.data
-            )
-            histogram_d_gpu_global, edges_d_gpu_global = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                dims=args.dims, number_of_events=args.data
-            )
-        if edges is None:
-            histogram_d_numpy, edges_d = np.histogramdd(input_data,
-                                                        bins=args.bins,
-                                                        weights=weights)
-        else:
-            histogram_d_numpy, edges_d = np.histogramdd(input_data,
-                                                        bins=edges,
-                                                        weights=weights)
-        # Next with single precision
-        ftype = np.float32
-        input_data, d_input_data = create_array(
-            n_elements=args.data,
-            n_dims=args.dims,
-            device_array=args.device_data,
-            ftype=ftype,
-            list_array=args.list_data
-        )
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_s_gpu_shared, edges_s_gpu_shared = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                dims=args.dims, number_of_events=args.data
-            )
-            histogram_s_gpu_global, edges_s_gpu_global = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                dims=args.dims, number_of_events=args.data
-            )
-        if edges is None:
-            histogram_s_numpy, edges_s = np.histogramdd(input_data,
-                                                        bins=args.bins,
-                                                        weights=weights)
-        else:
-            histogram_s_numpy, edges_s = np.histogramdd(input_data,
-                                                        bins=edges,
-                                                        weights=weights)
-        if args.outdir != None:
-            plot_histogram(histogram_d_gpu_shared, edges_d_gpu_shared,
-                           args.outdir, "GPU shared memory, double", args.bins)
-            plot_histogram(histogram_d_gpu_global, edges_d_gpu_global,
-                           args.outdir, "GPU global memory, double", args.bins)
-            plot_histogram(histogram_d_numpy, edges_d, args.outdir,
-                           "CPU, double", args.bins)
-            plot_histogram(histogram_s_gpu_shared, edges_s_gpu_shared,
-                           args.outdir, "GPU shared memory, single", args.bins)
-            plot_histogram(histogram_s_gpu_global, edges_s_gpu_global,
-                           args.outdir, "GPU global memory, single", args.bins)
-            plot_histogram(histogram_s_numpy, edges_s, args.outdir,
-                           "CPU, single", args.bins)
-        sys.exit()
+    # The events and weights of each precision on the host (for the CPU)
+    # and for the GPU. A histogrammer which exists already is reused.
+    precisions = [SimpleNamespace(
+        name='single' if ftype == np.float32 else 'double', ftype=ftype,
+        data=input_data, d_data=d_input_data, weights=weights,
+        d_weights=d_weights, stream=None, histogrammer=None)]
+    if args.full or args.all_precisions:
+        precisions.append(SimpleNamespace(
+            name='single', ftype=np.float32, data=input_data_s,
+            d_data=d_input_data_s, weights=weights_s, d_weights=d_weights_s,
+            stream=single_stream, histogrammer=single_histogrammer))
 
-    if args.gpu_both:
-        # if not args.all_precisions and args.single_precision then this is
-        # single precision. Hence the missing "d" or "s" in the name.
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_gpu_shared, edges_gpu_shared = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                dims=args.dims, number_of_events=args.data
-            )
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_gpu_global, edges_gpu_global = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                dims=args.dims, number_of_events=args.data
-            )
-        if args.all_precisions:
-            ftype = np.float32
-            input_data, d_input_data = create_array(
-                n_elements=args.data,
-                n_dims=args.dims,
-                device_array=args.device_data,
-                ftype=ftype,
-                list_array=args.list_data
-            )
-            with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-                histogram_s_gpu_shared, edges_s_gpu_shared = histogrammer.get_hist(
-                    sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                    dims=args.dims, number_of_events=args.data
-                )
-                histogram_s_gpu_global, edges_s_gpu_global = histogrammer.get_hist(
-                    sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                    dims=args.dims, number_of_events=args.data
-                )
-            if args.outdir != None:
-                plot_histogram(histogram_gpu_shared, edges_gpu_shared,
-                               args.outdir, "GPU shared memory, double",
-                               args.bins)
-                plot_histogram(histogram_gpu_global, edges_gpu_global,
-                               args.outdir, "GPU global memory, double",
-                               args.bins)
-                plot_histogram(histogram_s_gpu_shared, edges_s_gpu_shared,
-                               args.outdir, "GPU shared memory, single",
-                               args.bins)
-                plot_histogram(histogram_s_gpu_global, edges_s_gpu_global,
-                               args.outdir, "GPU global memory, single",
-                               args.bins)
-        elif args.outdir != None:
-            name = ""
-            if args.single_precision:
-                name = "single"
-            else:
-                name = "double"
-            plot_histogram(histogram_gpu_shared, edges_gpu_shared, args.outdir,
-                           "GPU shared memory, " + name, args.bins)
-            plot_histogram(histogram_gpu_global, edges_gpu_global, args.outdir,
-                           "GPU global memory, " + name, args.bins)
-
-    if args.gpu_shared and not args.gpu_both:
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_gpu_shared, edges_gpu_shared = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                dims=args.dims, number_of_events=args.data
-            )
-        if args.all_precisions:
-            ftype = np.float32
-            input_data, d_input_data = create_array(
-                n_elements=args.data,
-                n_dims=args.dims,
-                device_array=args.device_data,
-                ftype=ftype,
-                list_array=args.list_data
-            )
-            with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-                histogram_s_gpu_shared, edges_s_gpu_shared = histogrammer.get_hist(
-                    sample=d_input_data, bins=edges, weights=d_weights, shared=True,
-                    dims=args.dims, number_of_events=args.data
-                )
-            if args.outdir != None:
-                plot_histogram(histogram_gpu_shared, edges_gpu_shared,
-                               args.outdir, "GPU shared memory, double",
-                               args.bins)
-                plot_histogram(histogram_s_gpu_shared, edges_s_gpu_shared,
-                               args.outdir, "GPU shared memory, single",
-                               args.bins)
-        elif args.outdir != None:
-            name = ""
-            if args.single_precision:
-                name = "single"
-            else:
-                name = "double"
-            plot_histogram(histogram_gpu_shared, edges_gpu_shared, args.outdir,
-                           "GPU shared memory, " + name, args.bins)
-
-    if args.gpu_global and not args.gpu_both:
-        with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-            histogram_gpu_global, edges_gpu_global = histogrammer.get_hist(
-                sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                dims=args.dims, number_of_events=args.data
-            )
-        if args.all_precisions:
-            ftype = np.float32
-            input_data, d_input_data = create_array(
-                n_elements=args.data,
-                n_dims=args.dims,
-                device_array=args.device_data,
-                ftype=ftype,
-                list_array=args.list_data
-            )
-            with gpu_hist.GPUHist(ftype=ftype) as histogrammer:
-                histogram_s_gpu_global, edges_s_gpu_global = histogrammer.get_hist(
-                    sample=d_input_data, bins=edges, weights=d_weights, shared=False,
-                    dims=args.dims, number_of_events=args.data
-                )
-            if args.outdir != None:
-                plot_histogram(histogram_gpu_global, edges_gpu_global,
-                               args.outdir, "GPU global memory, double",
-                               args.bins)
-                plot_histogram(histogram_s_gpu_global, edges_s_gpu_global,
-                               args.outdir, "GPU global memory, single",
-                               args.bins)
-        elif args.outdir != None:
-            name = ""
-            if args.single_precision:
-                name = "single"
-            else:
-                name = "double"
-            plot_histogram(histogram_gpu_global, edges_gpu_global, args.outdir,
-                           "GPU global memory, " + name, args.bins)
-
-    if args.cpu:
-        if edges is None:
-            histogram_d_numpy, edges_d = np.histogramdd(
-                input_data,
-                bins=args.bins,
-                weights=weights
-            )
-        else:
-            histogram_d_numpy, edges_d = np.histogramdd(
-                input_data,
-                bins=edges,
-                weights=weights
-            )
-        if args.all_precisions:
-            ftype = np.float32
-            input_data, d_input_data = create_array(
-                n_elements=args.data,
-                n_dims=args.dims,
-                device_array=args.device_data,
-                ftype=ftype,
-                list_array=args.list_data
-            )
-            if edges is None:
-                histogram_s_numpy, edges_s = np.histogramdd(
-                    input_data,
-                    bins=args.bins,
-                    weights=weights
-                )
-            else:
-                histogram_s_numpy, edges_s = np.histogramdd(
-                    input_data,
-                    bins=edges,
-                    weights=weights
-                )
-        if args.outdir != None:
-            plot_histogram(histogram_d_numpy, edges_d, args.outdir,
-                           "CPU, double", args.bins)
-            if args.all_precisions:
-                plot_histogram(histogram_s_numpy, edges_s, args.outdir,
-                               "CPU, single", args.bins)
+    # The arguments of run_case which are the same for all histograms
+    cfg = SimpleNamespace(dims=args.dims, number_of_events=args.data)
+    # The histograms of one precision are plotted in the background while
+    # the next precision is calculated. A single worker because matplotlib
+    # is not thread-safe. get_hist returns copies of its buffers, hence the
+    # histograms can be handed over as they are.
+    plotter = None
+    plots = []
+    if args.outdir is not None:
+        plotter = ThreadPoolExecutor(max_workers=1)
+    edges_cpu = edges
+    for p in precisions:
+        entries = []
+        histogrammer = p.histogrammer
+        if histogrammer is None and gpu_modes:
+            histogrammer = gpu_hist.GPUHist(ftype=p.ftype)
+        if histogrammer is not None:
+            # One histogrammer for all memory modes of this precision
+            with histogrammer:
+                for memory_mode in gpu_modes:
+                    entries.append(run_case(
+                        histogrammer, memory_mode, p.name, p.d_data, edges,
+                        p.d_weights, stream=p.stream, **vars(cfg)))
+        if run_cpu:
+            entries.append(run_case(
+                None, 'cpu', p.name, p.data, edges_cpu, p.weights,
+                **vars(cfg)))
+            # Single precision uses the same bins as double precision.
+            # Edges computed from the range of the double precision events
+            # are widened since the extreme events may be rounded outside of
+            # them. Given edges are used as they are, like on the GPU.
+            if bins_are_counts(edges):
+                edges_cpu = widen_edges(entries[-1][1], np.float32)
+        if plotter is not None and entries:
+            plots.append(plotter.submit(
+                plot_histograms, entries, args.outdir, args.bins,
+                raw=args.raw, fast=args.fast_plots))
+    # The casts must be done before their buffers are freed
+    if cast_buffers:
+        single_stream.synchronize()
+    free_device_array(cast_buffers)
+
+    if plotter is not None:
+        plotter.shutdown(wait=True)
+        # Raise exceptions from the plots
+        for plot in plots:
+            plot.result()